@@ -1,3 +1,4 @@
+import inspect
 from math import ceil
 
 from torch.utils.data import DataLoader, Dataset, Sampler
@@ -10,7 +11,8 @@ class NamedDataLoader(DataLoader):
     the name of the tensor and the value is the tensor itself.
     """
 
-    def __init__(self, dataset, batch_size, sampler=None, tensor_names=None, num_workers=0, pin_memory=False):
+    def __init__(self, dataset, batch_size, sampler=None, tensor_names=None, num_workers=0, pin_memory=False,
+                 persistent_workers=False, prefetch_factor=2):
         """
         :param dataset: The dataset that will be wrapped by this NamedDataLoader
         :type dataset: Dataset
@@ -24,6 +26,12 @@ class NamedDataLoader(DataLoader):
         :type num_workers: int
         :param pin_memory: argument for Data Loader to use page-locked memory for faster transfer of data to GPU
         :type pin_memory: bool
+        :param persistent_workers: keep worker processes alive between epochs instead of respawning them
+                                   (only effective with num_workers > 0 and torch >= 1.7)
+        :type persistent_workers: bool
+        :param prefetch_factor: number of batches each worker loads ahead of consumption
+                                (only effective with num_workers > 0 and torch >= 1.7)
+        :type prefetch_factor: int
         """
 
         def collate_fn(batch):
@@ -57,6 +65,16 @@ class NamedDataLoader(DataLoader):
 
             return ret
 
+        # persistent_workers and prefetch_factor only exist from torch 1.7 on and are only
+        # accepted when workers are used
+        loader_kwargs = {}
+        if num_workers > 0:
+            dataloader_params = inspect.signature(DataLoader.__init__).parameters
+            if "persistent_workers" in dataloader_params:
+                loader_kwargs["persistent_workers"] = persistent_workers
+            if "prefetch_factor" in dataloader_params:
+                loader_kwargs["prefetch_factor"] = prefetch_factor
+
         super(NamedDataLoader, self).__init__(
             dataset=dataset,
             sampler=sampler,
@@ -64,6 +82,7 @@ class NamedDataLoader(DataLoader):
             collate_fn=collate_fn,
             pin_memory=pin_memory,
             num_workers=num_workers,
+            **loader_kwargs,
         )
 
     def __len__(self):
@@ -460,6 +460,43 @@ class Inferencer:
             else:
                 return predictions
 
+    def inference_from_dataset(self, dataset, tensor_names, baskets, return_json=True):
+        """
+        Run down-stream inference on an already featurized PyTorch dataset, skipping preprocessing.
+
+        Useful when the samples have been converted before, e.g. by an earlier call to
+        `Processor.dataset_from_dicts(..., return_baskets=True)`: the tokenization and feature
+        generation pass is not repeated.
+
+        :param dataset: PyTorch Dataset with the preprocessed samples
+        :param tensor_names: Names of the tensors in the dataset
+        :param baskets: SampleBaskets from the same preprocessing run. For each item in the dataset,
+                        they hold the additional information needed to create formatted preds.
+        :param return_json: Whether the output should be in a json appropriate format. If False, it returns the prediction
+                            object where applicable, else it returns PredObj.to_json()
+        :type return_json: bool
+        :return: list of predictions
+        :rtype: list
+        """
+        # whether to aggregate predictions across different samples (e.g. for QA on long texts)
+        aggregate_preds = False
+        if len(self.model.prediction_heads) > 0:
+            aggregate_preds = hasattr(self.model.prediction_heads[0], "aggregate_preds")
+
+        if aggregate_preds:
+            preds_all = self._get_predictions_and_aggregate(dataset, tensor_names, baskets)
+        else:
+            preds_all = self._get_predictions(dataset, tensor_names, baskets)
+
+        if return_json:
+            # TODO this try catch should be removed when all tasks return prediction objects
+            try:
+                preds_all = [x.to_json() for x in preds_all]
+            except AttributeError:
+                pass
+
+        return preds_all
+
     def _inference_without_multiprocessing(self, dicts, return_json, aggregate_preds):
         """
         Implementation of inference from dicts without using Python multiprocessing. Useful for debugging or in API
@@ -6,7 +6,13 @@ from pathlib import Path
 
 import multiprocessing
 import numpy
+import psutil
 import torch
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from torch import nn
 from transformers import AutoConfig
 from transformers.convert_graph_to_onnx import convert, quantize as quantize_model
@@ -26,6 +32,10 @@ class BaseAdaptiveModel:
     Base Class for implementing AdaptiveModel with frameworks like PyTorch and ONNX.
     """
 
+    # empty on purpose: lets slotted subclasses (ONNXAdaptiveModel) actually drop their per-instance
+    # __dict__, while nn.Module based subclasses keep theirs through their other base class
+    __slots__ = ()
+
     subclasses = {}
 
     def __init_subclass__(cls, **kwargs):
@@ -109,7 +119,6 @@ class BaseAdaptiveModel:
 
         # This case is triggered by Natural Questions
         else:
-            preds_final = [list() for _ in range(n_heads)]
             preds = kwargs.get("preds")
             if preds is not None:
                 preds_for_heads = stack(preds)
@@ -118,15 +127,15 @@ class BaseAdaptiveModel:
             else:
                 preds_for_heads = [None] * n_heads
                 logits_for_heads = logits
-            preds_final = [list() for _ in range(n_heads)]
 
             if not "samples" in kwargs:
                 samples = [s for b in kwargs["baskets"] for s in b.samples]
                 kwargs["samples"] = samples
 
-            for i, (head, preds_for_head, logits_for_head) in enumerate(zip(self.prediction_heads, preds_for_heads, logits_for_heads)):
-                preds = head.formatted_preds(logits=logits_for_head, preds=preds_for_head, **kwargs)
-                preds_final[i].append(preds)
+            preds_final = [
+                [head.formatted_preds(logits=logits_for_head, preds=preds_for_head, **kwargs)]
+                for head, preds_for_head, logits_for_head in zip(self.prediction_heads, preds_for_heads, logits_for_heads)
+            ]
 
             # Look for a merge() function amongst the heads and if a single one exists, apply it to preds_final
             merge_fn = pick_single_fn(self.prediction_heads, "merge_formatted_preds")
@@ -550,7 +559,8 @@ class AdaptiveModel(nn.Module, BaseAdaptiveModel):
 
 
     @classmethod
-    def convert_to_onnx(cls, model_name, output_path, task_type, convert_to_float16=False, quantize=False, opset_version=11):
+    def convert_to_onnx(cls, model_name, output_path, task_type, convert_to_float16=False, quantize=False,
+                        opset_version=11, input_int32=False):
         """
         Convert a PyTorch model from transformers hub to an ONNX Model.
 
@@ -568,6 +578,9 @@ class AdaptiveModel(nn.Module, BaseAdaptiveModel):
         :type quantize: bool
         :param opset_version: ONNX opset version
         :type opset_version: int
+        :param input_int32: cast the model inputs (input ids, attention mask, token type ids) to int32 once at
+                            export time, so the optimized GPU graph does not need per-forward Cast nodes
+        :type input_int32: bool
         :return:
         """
         language_model_class = LanguageModel.get_language_model_class(model_name)
@@ -611,7 +624,7 @@ class AdaptiveModel(nn.Module, BaseAdaptiveModel):
         with open(output_path / "onnx_model_config.json", "w") as f:
             json.dump(onnx_model_config, f)
 
-        if convert_to_float16:
+        if convert_to_float16 or input_int32:
             from onnxruntime_tools import optimizer
             config = AutoConfig.from_pretrained(model_name)
             optimized_model = optimizer.optimize_model(
@@ -620,13 +633,69 @@ class AdaptiveModel(nn.Module, BaseAdaptiveModel):
                 num_heads=config.num_hidden_layers,
                 hidden_size=config.hidden_size
             )
-            optimized_model.convert_model_float32_to_float16()
+            if convert_to_float16:
+                optimized_model.convert_model_float32_to_float16()
+            if input_int32:
+                optimized_model.change_input_to_int32()
             optimized_model.save_model_to_file(str(output_path/"model.onnx"))
 
         if quantize:
             quantize_model(output_path/"model.onnx")
 
 
+def _load_json_file(path):
+    """
+    Parse a small json config file, with the C-accelerated orjson when it is installed
+    (it is an optional dependency) and the stdlib json otherwise.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+# SessionOptions shared by every ONNX session of a device kind loaded in this process. Loading
+# several models (e.g. QA + NER in one Inferencer process) with per-session options would give each
+# session its own intra-op thread pool of cpu_count threads and oversubscribe the CPU.
+_shared_onnx_session_options = {}
+
+
+def _get_onnx_session_options(device):
+    """
+    Return the process-wide SessionOptions for the given device ("cpu"/"cuda" prefix), creating
+    and configuring it on first use.
+    """
+    import onnxruntime
+    device_kind = "cuda" if str(device).startswith("cuda") else "cpu"
+    sess_options = _shared_onnx_session_options.get(device_kind)
+    if sess_options is None:
+        sess_options = onnxruntime.SessionOptions()
+        # ORT_ENABLE_ALL additionally applies the layout-specific transformer fusions (Attention,
+        # SkipLayerNormalization, FastGelu, EmbedLayerNormalization) that EXTENDED leaves out.
+        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if device_kind == "cuda":
+            # Intra-op threads do not drive CUDA kernels; a single host thread per pool avoids
+            # oversubscribing the CPU threads that dispatch the kernel launches.
+            sess_options.intra_op_num_threads = 1
+            sess_options.inter_op_num_threads = 1
+        else:
+            # On CPU, throughput peaks around the physical core count; scheduling onto all logical
+            # cores (hyperthreads included) past that knee gives diminishing and often negative
+            # returns through cache and thread contention. OMP_NUM_THREADS still wins if set.
+            omp_num_threads = os.environ.get("OMP_NUM_THREADS")
+            if omp_num_threads:
+                sess_options.intra_op_num_threads = int(omp_num_threads)
+            else:
+                sess_options.intra_op_num_threads = psutil.cpu_count(logical=False) or multiprocessing.cpu_count()
+            sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        # back all sessions created with these options by one global ORT thread pool (newer ORT builds)
+        if hasattr(sess_options, "use_per_session_threads"):
+            sess_options.use_per_session_threads = False
+        _shared_onnx_session_options[device_kind] = sess_options
+    return sess_options
+
+
 class ONNXAdaptiveModel(BaseAdaptiveModel):
     """
     Implementation of ONNX Runtime for Inference of ONNX Models.
@@ -636,6 +705,14 @@ class ONNXAdaptiveModel(BaseAdaptiveModel):
 
     For inference, this class is compatible with the FARM Inferencer.
     """
+
+    # forward touches several of these attributes per batch; slots replace the per-instance
+    # __dict__ lookup with a C-level descriptor and drop the dict's memory overhead
+    __slots__ = ("onnx_session", "language_model_class", "language", "prediction_heads", "device",
+                 "input_dtype", "input_names", "output_names", "transpose_inputs", "io_binding",
+                 "pinned_output", "pinned_output_event", "input_buffers", "use_cuda_graph",
+                 "graph_inputs", "graph_outputs")
+
     def __init__(self, onnx_session, language_model_class, language, prediction_heads, device):
         import onnxruntime
         if str(device) == "cuda" and onnxruntime.get_device() != "GPU":
@@ -646,17 +723,132 @@ class ONNXAdaptiveModel(BaseAdaptiveModel):
         self.language = language
         self.prediction_heads = prediction_heads
         self.device = device
+        # models exported with input_int32=True expect int32 ids instead of torch's default int64
+        if any(onnx_input.type == "tensor(int32)" for onnx_input in onnx_session.get_inputs()):
+            self.input_dtype = numpy.int32
+        else:
+            self.input_dtype = numpy.int64
+        # mapping from FARM tensor names to the ONNX graph's input names
+        if language_model_class == "Bert":
+            self.input_names = {"input_ids": "input_ids", "padding_mask": "attention_mask",
+                                "segment_ids": "token_type_ids"}
+        else:  # Roberta, XLMRoberta
+            self.input_names = {"input_ids": "input_ids", "padding_mask": "attention_mask"}
+        self.output_names = [onnx_output.name for onnx_output in onnx_session.get_outputs()]
+        # Most exports are batch-first, but some graphs use a (seq_len, batch_size) layout. Probing
+        # the symbolic dims once here lets us transpose on the torch side instead of leaving ORT to
+        # insert a Transpose node in front of every input.
+        input_shape = onnx_session.get_inputs()[0].shape
+        first_dim = str(input_shape[0]).lower() if len(input_shape) > 1 else ""
+        second_dim = str(input_shape[1]).lower() if len(input_shape) > 1 else ""
+        self.transpose_inputs = "seq" in first_dim and "batch" in second_dim
+        # IOBinding for zero-copy GPU inference, created lazily on the first forward pass
+        self.io_binding = None
+        # reusable pinned (page-locked) staging tensor for uploading logits when IOBinding is
+        # unavailable, plus the event marking when its last async upload finished reading it
+        self.pinned_output = None
+        self.pinned_output_event = None
+        # reusable numpy input buffers (page-locked on CUDA), keyed by ONNX input name
+        self.input_buffers = {}
+        # CUDA graph replay reruns the captured kernels against the addresses bound during capture,
+        # so with the flag set each batch must be copied into the same persistent device buffers
+        self.use_cuda_graph = os.environ.get("FARM_ONNX_CUDA_GRAPH", "").lower() in ("1", "true")
+        self.graph_inputs = {}
+        self.graph_outputs = []
 
     @classmethod
     def load(cls, load_dir, device, **kwargs):
         load_dir = Path(load_dir)
         import onnxruntime
-        sess_options = onnxruntime.SessionOptions()
-        # Set graph optimization level to ORT_ENABLE_EXTENDED to enable bert optimization.
-        sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
-        # Use OpenMP optimizations. Only useful for CPU, has little impact for GPUs.
-        sess_options.intra_op_num_threads = multiprocessing.cpu_count()
-        onnx_session = onnxruntime.InferenceSession(str(load_dir / "model.onnx"), sess_options)
+        sess_options = _get_onnx_session_options(device)
+        model_file = load_dir / "model.onnx"
+        if str(device).startswith("cuda"):
+            # On GPU, run the graph at float16: transformer QA models tolerate half precision and
+            # Tensor-core GPUs roughly double their throughput at half the activation bandwidth.
+            # The converted graph is cached next to the original, and casts at the graph boundary
+            # keep the session's inputs/outputs float32 so callers are unaffected.
+            fp16_model_file = load_dir / "model.fp16.onnx"
+            if not fp16_model_file.is_file():
+                try:
+                    from onnxruntime_tools import optimizer
+                    num_heads, hidden_size = 12, 768
+                    lm_config_file = load_dir / "language_model_config.json"
+                    if lm_config_file.is_file():
+                        lm_config = _load_json_file(lm_config_file)
+                        num_heads = lm_config.get("num_attention_heads", num_heads)
+                        hidden_size = lm_config.get("hidden_size", hidden_size)
+                    optimized_model = optimizer.optimize_model(
+                        input=str(model_file),
+                        model_type="bert",
+                        num_heads=num_heads,
+                        hidden_size=hidden_size,
+                    )
+                    # cast_input_output=True is the default, but the IOBinding path binds float32
+                    # output buffers, so request the boundary casts explicitly instead of relying
+                    # on the tool version's default
+                    optimized_model.convert_model_float32_to_float16(cast_input_output=True)
+                    optimized_model.save_model_to_file(str(fp16_model_file))
+                except ImportError:
+                    logger.warning("onnxruntime_tools is not installed. Inference will run the ONNX "
+                                   "model at float32; install onnxruntime_tools to enable the faster "
+                                   "float16 path on GPU.")
+                except Exception as e:
+                    # e.g. a read-only model directory (save_model_to_file writes into load_dir) or
+                    # a graph the optimizer cannot fuse — fall back to the float32 model either way
+                    logger.warning(f"Could not convert the ONNX model to float16, inference will run "
+                                   f"at float32: {e}")
+                    if fp16_model_file.is_file():
+                        # do not leave a partially written file behind for later loads to pick up
+                        fp16_model_file.unlink()
+            if fp16_model_file.is_file():
+                # the fp16 graph is already fused offline, so no need to serialize an optimized copy
+                model_file = fp16_model_file
+        device_kind = "cuda" if str(device).startswith("cuda") else "cpu"
+        if model_file.name == "model.onnx":
+            # the serialized graph is specific to the execution provider it was optimized for,
+            # so the cache file is keyed by device kind and never shared between CPU and CUDA loads
+            optimized_model_file = load_dir / f"model.opt.{device_kind}.onnx"
+            if optimized_model_file.is_file():
+                # a fused graph serialized by an earlier load exists, so skip re-running the fusion passes
+                model_file = optimized_model_file
+            else:
+                # serialize the fused graph on first load, so later instantiations can reuse it;
+                # the path is reset below because the options object is shared across loads
+                sess_options.optimized_model_filepath = str(optimized_model_file)
+        if device_kind == "cuda":
+            cuda_provider_options = {
+                # HEURISTIC picks conv algorithms from a lookup table instead of running the slow
+                # exhaustive benchmark during warmup
+                "cudnn_conv_algo_search": "HEURISTIC",
+                "do_copy_in_default_stream": True,
+            }
+            # CUDA graph capture removes per-op kernel launch overhead, but replay requires every
+            # batch to have identical shapes and the bound buffers to keep their addresses.
+            # _forward_with_iobinding copies batches into persistent device buffers when the flag
+            # is set and raises on a shape change (e.g. a smaller final batch), so this stays opt-in
+            if os.environ.get("FARM_ONNX_CUDA_GRAPH", "").lower() in ("1", "true"):
+                cuda_provider_options["enable_cuda_graph"] = True
+            session_kwargs = {"providers": [("CUDAExecutionProvider", cuda_provider_options), "CPUExecutionProvider"]}
+        else:
+            session_kwargs = {}
+        try:
+            try:
+                onnx_session = onnxruntime.InferenceSession(str(model_file), sess_options, **session_kwargs)
+            except Exception as e:
+                if not sess_options.optimized_model_filepath:
+                    raise
+                # e.g. a read-only model directory: retry without serializing the fused graph,
+                # the fusion passes then just run again on the next load
+                logger.warning(f"Could not serialize the optimized ONNX graph to "
+                               f"{sess_options.optimized_model_filepath}, continuing without the "
+                               f"cache: {e}")
+                sess_options.optimized_model_filepath = ""
+                onnx_session = onnxruntime.InferenceSession(str(model_file), sess_options, **session_kwargs)
+        finally:
+            # always detach the serialization path from the shared options object, even when
+            # session creation fails — otherwise the next model loaded in this process would
+            # serialize its fused graph into this model's directory
+            sess_options.optimized_model_filepath = ""
 
         # Prediction heads
         _, ph_config_files = cls._get_prediction_head_files(load_dir, strict=False)
@@ -669,10 +861,9 @@ class ONNXAdaptiveModel(BaseAdaptiveModel):
             prediction_heads.append(head)
             ph_output_type.append(head.ph_output_type)
 
-        with open(load_dir/"onnx_model_config.json") as f:
-            model_config = json.load(f)
-            language_model_class = model_config["language_model_class"]
-            language = model_config["language"]
+        model_config = _load_json_file(load_dir/"onnx_model_config.json")
+        language_model_class = model_config["language_model_class"]
+        language = model_config["language"]
 
         return cls(onnx_session, language_model_class, language, prediction_heads, device)
 
@@ -683,24 +874,124 @@ class ONNXAdaptiveModel(BaseAdaptiveModel):
         :param kwargs: all arguments that needs to be passed on to the model
         :return: all logits as torch.tensor or multiple tensors.
         """
-        with torch.no_grad():
-            if self.language_model_class == "Bert":
-                input_to_onnx = {
-                    'input_ids': numpy.ascontiguousarray(kwargs['input_ids'].cpu().numpy()),
-                    'attention_mask': numpy.ascontiguousarray(kwargs['padding_mask'].cpu().numpy()),
-                    'token_type_ids': numpy.ascontiguousarray(kwargs['segment_ids'].cpu().numpy()),
-                }
-            elif self.language_model_class in ["Roberta", "XLMRoberta"]:
-                input_to_onnx = {
-                    'input_ids': numpy.ascontiguousarray(kwargs['input_ids'].cpu().numpy()),
-                    'attention_mask': numpy.ascontiguousarray(kwargs['padding_mask'].cpu().numpy())
-                }
-            res = self.onnx_session.run(None, input_to_onnx)
-            res = numpy.stack(res).transpose(1, 2, 0)
-            logits = [torch.Tensor(res).to(self.device)]
+        use_cuda = str(self.device).startswith("cuda")
+        # prefer inference_mode (torch>=1.9) over no_grad: it also drops view/version-counter tracking
+        grad_context = torch.inference_mode if hasattr(torch, "inference_mode") else torch.no_grad
+        with grad_context():
+            if use_cuda and hasattr(self.onnx_session, "io_binding"):
+                logits = self._forward_with_iobinding(kwargs)
+            else:
+                input_to_onnx = {}
+                for farm_name, onnx_name in self.input_names.items():
+                    tensor = kwargs[farm_name]
+                    if self.transpose_inputs:
+                        tensor = tensor.transpose(0, 1).contiguous()
+                    arr = tensor.cpu().numpy().astype(self.input_dtype, copy=False)
+                    buffer = self.input_buffers.get(onnx_name)
+                    if buffer is None or buffer.shape != arr.shape:
+                        if use_cuda:
+                            torch_dtype = torch.int32 if self.input_dtype is numpy.int32 else torch.int64
+                            buffer = torch.empty(arr.shape, dtype=torch_dtype, pin_memory=True).numpy()
+                        else:
+                            buffer = numpy.empty(arr.shape, dtype=self.input_dtype)
+                        self.input_buffers[onnx_name] = buffer
+                    numpy.copyto(buffer, arr)
+                    input_to_onnx[onnx_name] = buffer
+                res = self.onnx_session.run(None, input_to_onnx)
+                res = numpy.stack(res)
+                # normalize to (batch_size, seq_len, n_outputs) regardless of the graph's layout
+                res = res.transpose(2, 1, 0) if self.transpose_inputs else res.transpose(1, 2, 0)
+                if use_cuda:
+                    # route the upload through a reusable pinned staging tensor, so the copy to the
+                    # GPU is a DMA transfer instead of a pageable-memory copy
+                    if self.pinned_output is None or tuple(self.pinned_output.shape) != res.shape:
+                        self.pinned_output = torch.empty(res.shape, dtype=torch.float32, pin_memory=True)
+                    elif self.pinned_output_event is not None:
+                        # the previous batch's async upload may still be reading the buffer;
+                        # wait for it before overwriting
+                        self.pinned_output_event.synchronize()
+                    numpy.copyto(self.pinned_output.numpy(), res)
+                    logits = [self.pinned_output.to(self.device, non_blocking=True)]
+                    if self.pinned_output_event is None:
+                        self.pinned_output_event = torch.cuda.Event()
+                    self.pinned_output_event.record()
+                else:
+                    logits = [torch.Tensor(res)]
 
         return logits
 
+    def _forward_with_iobinding(self, kwargs):
+        """
+        Runs the ONNX session with IOBinding: inputs and outputs stay resident on the GPU and are bound
+        by their raw CUDA pointers, which removes the three device-to-host input copies and the
+        host-to-device output copy that the numpy path pays on every batch.
+        """
+        if self.io_binding is None:
+            self.io_binding = self.onnx_session.io_binding()
+        device = torch.device(self.device)
+        device_id = device.index if device.index is not None else 0
+        torch_dtype = torch.int32 if self.input_dtype is numpy.int32 else torch.int64
+
+        # keep references to the bound tensors so their memory stays alive over the run
+        bound_inputs = []
+        for farm_name, onnx_name in self.input_names.items():
+            tensor = kwargs[farm_name]
+            if self.transpose_inputs:
+                tensor = tensor.transpose(0, 1)
+            tensor = tensor.to(device=device, dtype=torch_dtype, non_blocking=True)
+            # batches stacked by the DataLoader are already C-contiguous; only copy when not
+            if not tensor.is_contiguous():
+                tensor = tensor.contiguous()
+            if self.use_cuda_graph:
+                # graph replay reruns the capture against fixed addresses, so route every batch
+                # through the same persistent device buffer instead of binding fresh tensors
+                graph_input = self.graph_inputs.get(onnx_name)
+                if graph_input is None:
+                    graph_input = torch.empty_like(tensor)
+                    self.graph_inputs[onnx_name] = graph_input
+                elif graph_input.shape != tensor.shape:
+                    raise ValueError(f"FARM_ONNX_CUDA_GRAPH requires every batch to have the same shape: "
+                                     f"input '{onnx_name}' changed from {tuple(graph_input.shape)} to "
+                                     f"{tuple(tensor.shape)}. Drop incomplete batches or disable the flag.")
+                graph_input.copy_(tensor)
+                tensor = graph_input
+            bound_inputs.append(tensor)
+            self.io_binding.bind_input(
+                name=onnx_name,
+                device_type="cuda",
+                device_id=device_id,
+                element_type=self.input_dtype,
+                shape=tuple(tensor.shape),
+                buffer_ptr=tensor.data_ptr(),
+            )
+        # QA models output one (batch_size, seq_len) logits tensor per output (start/end);
+        # seq-first graphs produce them in the same (seq_len, batch_size) layout as their inputs
+        out_shape = tuple(bound_inputs[0].shape)
+        if self.use_cuda_graph and not self.graph_outputs:
+            # outputs need stable addresses across replays as well
+            self.graph_outputs = [torch.empty(out_shape, dtype=torch.float32, device=device)
+                                  for _ in self.output_names]
+        bound_outputs = []
+        for i, output_name in enumerate(self.output_names):
+            if self.use_cuda_graph:
+                out = self.graph_outputs[i]
+            else:
+                out = torch.empty(out_shape, dtype=torch.float32, device=device)
+            bound_outputs.append(out)
+            self.io_binding.bind_output(
+                name=output_name,
+                device_type="cuda",
+                device_id=device_id,
+                element_type=numpy.float32,
+                shape=out_shape,
+                buffer_ptr=out.data_ptr(),
+            )
+        self.onnx_session.run_with_iobinding(self.io_binding)
+        if self.transpose_inputs:
+            bound_outputs = [out.transpose(0, 1) for out in bound_outputs]
+        # same layout as numpy.stack(res).transpose(1, 2, 0): (batch_size, seq_len, n_outputs)
+        return [torch.stack(bound_outputs, dim=-1)]
+
     def eval(self):
         """
         Stub to make ONNXAdaptiveModel compatible with the PyTorch AdaptiveModel.
@@ -725,7 +1016,11 @@ class ONNXWrapper(AdaptiveModel):
     """
     @classmethod
     def load_from_adaptive_model(cls, adaptive_model):
-        model = copy.deepcopy(adaptive_model)
+        # A shallow copy is enough here: only the class of the top-level object needs to change so
+        # that torch.onnx.export hits our positional forward. The submodules stay shared with the
+        # original model, which is fine because the export only reads their parameters. This avoids
+        # deep-copying all model weights, which transiently doubles resident memory.
+        model = copy.copy(adaptive_model)
         model.__class__ = ONNXWrapper
         return model
 
@@ -1,24 +1,41 @@
-import copy
+import contextlib
+import functools
+import itertools
 import json
 import logging
 import os
+import sys
 from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import multiprocessing
-import numpy
 import torch
 from torch import nn
 
 from farm.data_handler.processor import TextSimilarityProcessor
 from farm.data_handler.data_silo import DataSilo
-from farm.modeling.language_model import LanguageModel
+from farm.modeling.language_model import LanguageModel, DPRContextEncoder, DPRQuestionEncoder
 from farm.modeling.prediction_head import PredictionHead, TextSimilarityHead
 from farm.modeling.tokenization import Tokenizer
 from farm.utils import MLFlowLogger as MlLogger, stack
 
 logger = logging.getLogger(__name__)
 
+# extraction strategies that map to the pooled ("per sequence") LM output
+_PER_SEQUENCE_OUTPUT_TYPES = frozenset({"per_sequence", "per_sequence_continuous"})
+
+# Opt-in: enable the legacy JIT fusers so nvFuser/NNC can fuse the dropout + linear + elementwise
+# chains of the prediction heads into single kernels. Gated behind an env variable because turning
+# off the profiling executor is a process-wide setting that also affects other torch.jit users.
+if os.getenv("FARM_ENABLE_JIT_FUSER") and sys.platform != "darwin":
+    try:
+        torch._C._jit_set_profiling_executor(False)
+        torch._C._jit_set_profiling_mode(False)
+        torch._C._jit_override_can_fuse_on_gpu(True)
+        torch._C._jit_override_can_fuse_on_cpu(True)
+    except AttributeError:
+        logger.warning("FARM_ENABLE_JIT_FUSER is set, but this torch version does not expose the legacy JIT fuser flags")
+
 
 class BaseBiAdaptiveModel:
     """
@@ -62,6 +79,9 @@ class BaseBiAdaptiveModel:
         :param label_maps: dict
         :return: A list of all predictions from all prediction heads
         """
+        if len(self.prediction_heads) == 1:
+            # common single-head case: skip the zip/loop machinery
+            return [self.prediction_heads[0].logits_to_preds(logits=logits[0], **kwargs)]
         all_preds = []
         # collect preds from all heads
         for head, logits_for_head in zip(self.prediction_heads, logits):
@@ -88,8 +108,8 @@ class BaseBiAdaptiveModel:
             # (see Inferencer._get_predictions())
             try:
                 preds = kwargs["preds"]
-                temp = [y[0] for y in preds]
-                preds_flat = [item for sublist in temp for item in sublist]
+                # flatten in C via itertools instead of a nested Python comprehension
+                preds_flat = list(itertools.chain.from_iterable(y[0] for y in preds))
                 kwargs["preds"] = preds_flat
             except KeyError:
                 kwargs["preds"] = None
@@ -113,27 +133,59 @@ class BaseBiAdaptiveModel:
         """
 
         for head in self.prediction_heads:
-            head.label_tensor_name = tasks[head.task_name]["label_tensor_name"]
-            label_list = tasks[head.task_name]["label_list"]
+            task = tasks[head.task_name]
+            label_list = task["label_list"]
             if not label_list and require_labels:
                 raise Exception(f"The task \'{head.task_name}\' is missing a valid set of labels")
-            label_list = tasks[head.task_name]["label_list"]
+            head.label_tensor_name = task["label_tensor_name"]
             head.label_list = label_list
-            num_labels = len(label_list)
-            head.metric = tasks[head.task_name]["metric"]
+            head.metric = task["metric"]
+        # one-time marker, so the per-batch loss path does not need to probe each head again
+        self._heads_connected = True
 
     @classmethod
     def _get_prediction_head_files(cls, load_dir, strict=True):
         load_dir = Path(load_dir)
-        files = os.listdir(load_dir)
+        # the scan is cached on (path, mtime), so loading several models from the same directory
+        # only hits the filesystem once
+        return list(_scan_prediction_head_config_files(str(load_dir), os.stat(load_dir).st_mtime_ns))
+
+
+@functools.lru_cache(maxsize=128)
+def _scan_prediction_head_config_files(load_dir, mtime_ns):
+    """
+    Scans a model directory for prediction head config files. The mtime_ns argument is only part of the
+    signature to invalidate the cache when the directory content changes.
+    """
+    load_dir = Path(load_dir)
+    with os.scandir(load_dir) as entries:
         config_files = [
-            load_dir / f
-            for f in files
-            if "config.json" in f and "prediction_head" in f
+            load_dir / entry.name
+            for entry in entries
+            if "config.json" in entry.name and "prediction_head" in entry.name
         ]
-        # sort them to get correct order in case of multiple prediction heads
-        config_files.sort()
-        return config_files
+    # sort them to get correct order in case of multiple prediction heads
+    config_files.sort()
+    return tuple(config_files)
+
+def _maybe_to(module, device):
+    """
+    Moves a module to a device, skipping the full parameter traversal that module.to() performs
+    when the module already lives on the target device.
+    """
+    target = torch.device(device)
+    if target.type == "cuda" and target.index is None and torch.cuda.is_available():
+        # parameters report an indexed device ("cuda:0"), so a bare "cuda" target would
+        # never compare equal and the traversal would never be skipped
+        target = torch.device("cuda", torch.cuda.current_device())
+    try:
+        if next(module.parameters()).device == target:
+            return module
+    except StopIteration:
+        # modules without parameters are trivially "on" any device
+        pass
+    return module.to(device)
+
 
 def loss_per_head_sum(loss_per_head, global_step=None, batch=None):
     """
@@ -156,6 +208,8 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         lm1_output_types=["per_sequence"],
         lm2_output_types=["per_sequence"],
         loss_aggregation_fn=None,
+        use_compile=False,
+        amp_dtype=None,
     ):
         """
         :param language_model1: Any model that turns token ids into vector representations
@@ -191,28 +245,57 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
                                     Note: The loss at this stage is per sample, i.e one tensor of
                                     shape (batchsize) per prediction head.
         :type loss_aggregation_fn: function
+        :param use_compile: Compile the forward pass with torch.compile() to cut Python dispatch overhead
+                            on hot inference paths. Ignored on torch versions without torch.compile.
+        :type use_compile: bool
+        :param amp_dtype: Run the forward pass (both language models and heads) under autocast with this
+                          dtype, e.g. torch.float16 or torch.bfloat16. bfloat16 is preferred as it needs
+                          no GradScaler during training, but requires torch>=1.10; on older versions the
+                          fp16-only torch.cuda.amp.autocast is used instead. Loss aggregation stays
+                          outside autocast, so gradients remain FP32. Default None disables autocast.
+        :type amp_dtype: torch.dtype
         """
 
         super(BiAdaptiveModel, self).__init__()
         self.device = device
-        self.language_model1 = language_model1.to(device)
+        # CUDA streams for overlapping the two language model forward passes, lazily created in forward_lm()
+        self._lm1_stream = None
+        self._lm2_stream = None
+        self.language_model1 = _maybe_to(language_model1, device)
         self.lm1_output_dims = language_model1.get_output_dims()
-        self.language_model2 = language_model2.to(device)
+        self.language_model2 = _maybe_to(language_model2, device)
         self.lm2_output_dims = language_model2.get_output_dims()
         self.dropout1 = nn.Dropout(embeds_dropout_prob)
         self.dropout2 = nn.Dropout(embeds_dropout_prob)
-        self.prediction_heads = nn.ModuleList([ph.to(device) for ph in prediction_heads])
+        self.prediction_heads = nn.ModuleList([_maybe_to(ph, device) for ph in prediction_heads])
+        self._single_head = len(self.prediction_heads) == 1
+        # populated by eval_optimize() with scripted + frozen copies of the heads
+        self._scripted_heads = None
         self.lm1_output_types = (
             [lm1_output_types] if isinstance(lm1_output_types, str) else lm1_output_types
         )
         self.lm2_output_types = (
             [lm2_output_types] if isinstance(lm2_output_types, str) else lm2_output_types
         )
+        # the output types are fixed for the lifetime of the model, so validate them once here and
+        # keep the per-batch head loop in forward() free of string comparisons
+        for lm_name, output_types in (("language_model1", self.lm1_output_types),
+                                      ("language_model2", self.lm2_output_types)):
+            for output_type in output_types:
+                if output_type not in _PER_SEQUENCE_OUTPUT_TYPES:
+                    raise ValueError(f"Unknown extraction strategy from BiAdaptive {lm_name}: {output_type}")
+        self.amp_dtype = amp_dtype
         self.log_params()
         # default loss aggregation function is a simple sum (without using any of the optional params)
         if not loss_aggregation_fn:
             loss_aggregation_fn = loss_per_head_sum
         self.loss_aggregation_fn = loss_aggregation_fn
+        # Optionally let TorchDynamo/TorchInductor trace the whole forward (both LMs + heads) into one
+        # fused graph. The uncompiled forward is kept around for training or debugging.
+        self._uncompiled_forward = None
+        if use_compile and hasattr(torch, "compile"):
+            self._uncompiled_forward = self.forward
+            self.forward = torch.compile(self.forward, mode="reduce-overhead", dynamic=True)
 
     def save(self, save_dir, lm1_name="lm1", lm2_name="lm2"):
         """
@@ -221,13 +304,20 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         :param save_dir: path to save to
         :type save_dir: Path
         """
+        save_dir = Path(save_dir)
+        lm1_dir = save_dir / lm1_name
+        lm2_dir = save_dir / lm2_name
         os.makedirs(save_dir, exist_ok=True)
-        if not os.path.exists(Path.joinpath(save_dir, Path(lm1_name))):
-            os.makedirs(Path.joinpath(save_dir, Path(lm1_name)))
-        if not os.path.exists(Path.joinpath(save_dir, Path(lm2_name))):
-            os.makedirs(Path.joinpath(save_dir, Path(lm2_name)))
-        self.language_model1.save(Path.joinpath(save_dir, Path(lm1_name)))
-        self.language_model2.save(Path.joinpath(save_dir, Path(lm2_name)))
+        os.makedirs(lm1_dir, exist_ok=True)
+        os.makedirs(lm2_dir, exist_ok=True)
+        # the two language models are independent, so their I/O bound saves can run in parallel
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [
+                executor.submit(self.language_model1.save, lm1_dir),
+                executor.submit(self.language_model2.save, lm2_dir),
+            ]
+            for future in futures:
+                future.result()
         for i, ph in enumerate(self.prediction_heads):
             logger.info("prediction_head saving")
             ph.save(save_dir, i)
@@ -297,13 +387,14 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         :type logits: object
         :return: The per sample per prediciton head loss whose first two dimensions have length n_pred_heads, batch_size
         """
-        all_losses = []
-        for head, logits_for_one_head in zip(self.prediction_heads, logits):
-            # check if PredictionHead connected to Processor
-            assert hasattr(head, "label_tensor_name"), \
-                (f"Label_tensor_names are missing inside the {head.task_name} Prediction Head. Did you connect the model"
+        # check once if the PredictionHeads are connected to a Processor, instead of probing each head per batch
+        if not getattr(self, "_heads_connected", False):
+            raise RuntimeError(
+                "Label_tensor_names are missing inside the Prediction Heads. Did you connect the model"
                 " with the processor through either 'model.connect_heads_with_processor(processor.tasks)'"
                 " or by passing the processor to the Adaptive Model?")
+        all_losses = []
+        for head, logits_for_one_head in zip(self.prediction_heads, logits):
             all_losses.append(head.logits_to_loss(logits=logits_for_one_head, **kwargs))
         return all_losses
 
@@ -321,6 +412,9 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         :return loss: torch.tensor that is the per sample loss (len: batch_size)
         """
         all_losses = self.logits_to_loss_per_head(logits, **kwargs)
+        if self._single_head and self.loss_aggregation_fn is loss_per_head_sum:
+            # single head + default sum: aggregating a one-element list is wasted work
+            return all_losses[0]
         # This aggregates the loss per sample across multiple prediction heads
         # Default is sum(), but you can configure any fn that takes [Tensor, Tensor ...] and returns [Tensor]
         loss = self.loss_aggregation_fn(all_losses, global_step=global_step, batch=kwargs)
@@ -334,6 +428,8 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         :type label_maps: dict[int:str]
         :return: labels in the right format
         """
+        if self._single_head:
+            return [self.prediction_heads[0].prepare_labels(**kwargs)]
         all_labels = []
         # for head, label_map_one_head in zip(self.prediction_heads):
         #     labels = head.prepare_labels(label_map=label_map_one_head, **kwargs)
@@ -353,33 +449,52 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         :return: all logits as torch.tensor or multiple tensors.
         """
 
+        with self._autocast_context():
+            return self._forward_impl(**kwargs)
+
+    def _autocast_context(self):
+        """Context manager for mixed precision in the forward pass, based on the amp_dtype init arg."""
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        if hasattr(torch, "autocast"):
+            # torch >= 1.10: autocast supports CPU + GPU and a configurable dtype (e.g. bfloat16)
+            device_type = "cuda" if str(self.device).startswith("cuda") else "cpu"
+            return torch.autocast(device_type=device_type, dtype=self.amp_dtype)
+        # older torch versions only ship the fp16 GPU autocast
+        return torch.cuda.amp.autocast()
+
+    def _forward_impl(self, **kwargs):
         # Run forward pass of both language models
         pooled_output = self.forward_lm(**kwargs)
 
+        # cuBLAS silently copies non-contiguous inputs inside the heads' matmuls, so contiguity is
+        # enforced once at this boundary (e.g. after pooling/slicing in the LM) instead of once per head.
+        pooled_output = tuple(
+            t.contiguous() if t is not None and not t.is_contiguous() else t for t in pooled_output
+        )
+
         # Run forward pass of (multiple) prediction heads using the output from above
         all_logits = []
         if len(self.prediction_heads) > 0:
-            for head, lm1_out, lm2_out in zip(self.prediction_heads, self.lm1_output_types, self.lm2_output_types):
-                # Choose relevant vectors from LM as output and perform dropout
+            # All valid extraction strategies feed the same pooled outputs through the same dropouts, so the
+            # dropout result can be shared across heads instead of being recomputed per head. During training
+            # with several heads each head keeps its own dropout mask to preserve the previous behaviour.
+            share_dropout_output = not self.training or len(self.prediction_heads) == 1
+            shared_output1 = shared_output2 = None
+            if share_dropout_output:
                 if pooled_output[0] is not None:
-                    if lm1_out == "per_sequence" or lm1_out == "per_sequence_continuous":
-                        output1 = self.dropout1(pooled_output[0])
-                    else:
-                        raise ValueError(
-                            "Unknown extraction strategy from BiAdaptive language_model1: {}".format(lm1_out)
-                        )
-                else:
-                    output1 = None
-
+                    shared_output1 = self.dropout1(pooled_output[0])
                 if pooled_output[1] is not None:
-                    if lm2_out == "per_sequence" or lm2_out == "per_sequence_continuous":
-                        output2 = self.dropout2(pooled_output[1])
-                    else:
-                        raise ValueError(
-                            "Unknown extraction strategy from BiAdaptive language_model2: {}".format(lm2_out)
-                        )
+                    shared_output2 = self.dropout2(pooled_output[1])
+            heads = self._scripted_heads if self._scripted_heads is not None else self.prediction_heads
+            for head in heads:
+                # the extraction strategies were validated in __init__ and all valid ones map to the
+                # pooled output, so no per-head dispatch on the output type is needed here
+                if share_dropout_output:
+                    output1, output2 = shared_output1, shared_output2
                 else:
-                    output2 = None
+                    output1 = self.dropout1(pooled_output[0]) if pooled_output[0] is not None else None
+                    output2 = self.dropout2(pooled_output[1]) if pooled_output[1] is not None else None
 
                 embedding1, embedding2 = head(output1, output2)
                 all_logits.append(tuple([embedding1, embedding2]))
@@ -396,16 +511,97 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         :param kwargs:
         :return: 2 tensors of pooled_output from the 2 language models
         """
+        # Move any caller-provided CPU tensors to the model's device once, asynchronously, instead of
+        # paying one implicit blocking copy per tensor per language model. For a true async copy the
+        # DataLoader should be run with pin_memory=True.
+        for name, tensor in kwargs.items():
+            if isinstance(tensor, torch.Tensor) and tensor.device != self.device:
+                kwargs[name] = tensor.to(self.device, non_blocking=True)
+
         pooled_output = [None, None]
-        if "query_input_ids" in kwargs.keys():
-            pooled_output1, hidden_states1 = self.language_model1(**kwargs)
-            pooled_output[0] = pooled_output1
-        if "passage_input_ids" in kwargs.keys():
-            pooled_output2, hidden_states2 = self.language_model2(**kwargs)
-            pooled_output[1] = pooled_output2
+        run_lm1 = "query_input_ids" in kwargs.keys()
+        run_lm2 = "passage_input_ids" in kwargs.keys()
+
+        if run_lm1 and run_lm2 and self.language_model1 is self.language_model2:
+            # Shared encoder: one big batched call fills the GPU better than two half-sized ones
+            return self._forward_lm_tied(kwargs)
+
+        if run_lm1 and run_lm2 and torch.cuda.is_available() and str(self.device).startswith("cuda"):
+            # The two encoders are independent, so each one is launched on its own CUDA stream.
+            # This lets the GPU scheduler overlap their kernels instead of serializing the two forward passes.
+            if self._lm1_stream is None:
+                self._lm1_stream = torch.cuda.Stream(device=self.device)
+                self._lm2_stream = torch.cuda.Stream(device=self.device)
+            current_stream = torch.cuda.current_stream()
+            self._lm1_stream.wait_stream(current_stream)
+            self._lm2_stream.wait_stream(current_stream)
+            with torch.cuda.stream(self._lm1_stream):
+                pooled_output[0], hidden_states1 = self.language_model1(**kwargs)
+            with torch.cuda.stream(self._lm2_stream):
+                pooled_output[1], hidden_states2 = self.language_model2(**kwargs)
+            # sync back so the dropouts and prediction heads downstream see both results
+            current_stream.wait_stream(self._lm1_stream)
+            current_stream.wait_stream(self._lm2_stream)
+        else:
+            if run_lm1:
+                pooled_output1, hidden_states1 = self.language_model1(**kwargs)
+                pooled_output[0] = pooled_output1
+            if run_lm2:
+                pooled_output2, hidden_states2 = self.language_model2(**kwargs)
+                pooled_output[1] = pooled_output2
 
         return tuple(pooled_output)
 
+    def eval_optimize(self):
+        """
+        Optimizes the prediction heads for inference-only deployments. Each head is scripted and frozen
+        with torch.jit, which constant-folds its parameters and removes Python dispatch from the per-batch
+        head call in forward(). The original heads stay in self.prediction_heads, so loss computation,
+        prediction formatting and saving keep working; only the forward call is routed through the frozen
+        modules. Do not call this on a model that should be trained afterwards, as the heads are switched
+        to eval mode.
+        """
+        if not hasattr(torch.jit, "freeze"):
+            raise RuntimeError("Optimizing the prediction heads requires torch>=1.8 for torch.jit.freeze")
+        self._scripted_heads = [torch.jit.freeze(torch.jit.script(head.eval())) for head in self.prediction_heads]
+
+    def _forward_lm_tied(self, kwargs):
+        """
+        Runs a single forward pass through the shared encoder when language_model1 and language_model2 are
+        the same module. The query and (flattened) passage inputs are concatenated along the batch
+        dimension, encoded once and the pooled outputs split again, which amortizes kernel launches
+        compared to two half-sized calls.
+        """
+        max_seq_len = kwargs["passage_input_ids"].shape[-1]
+        if kwargs["query_input_ids"].shape[-1] != max_seq_len:
+            raise ValueError(
+                f"Cannot fuse the query and passage forward passes of a tied encoder: "
+                f"query seq len {kwargs['query_input_ids'].shape[-1]} != passage seq len {max_seq_len}"
+            )
+        n_queries = kwargs["query_input_ids"].shape[0]
+        input_ids = torch.cat([kwargs["query_input_ids"], kwargs["passage_input_ids"].view(-1, max_seq_len)], dim=0)
+        segment_ids = torch.cat([kwargs["query_segment_ids"], kwargs["passage_segment_ids"].view(-1, max_seq_len)], dim=0)
+        attention_mask = torch.cat(
+            [kwargs["query_attention_mask"], kwargs["passage_attention_mask"].view(-1, max_seq_len)], dim=0
+        )
+        # the shared module only declares one set of argument names, so address it by its type
+        if isinstance(self.language_model1, DPRQuestionEncoder):
+            pooled_output, _ = self.language_model1(
+                query_input_ids=input_ids,
+                query_segment_ids=segment_ids,
+                query_attention_mask=attention_mask,
+            )
+        elif isinstance(self.language_model1, DPRContextEncoder):
+            pooled_output, _ = self.language_model1(
+                passage_input_ids=input_ids,
+                passage_segment_ids=segment_ids,
+                passage_attention_mask=attention_mask,
+            )
+        else:
+            pooled_output, _ = self.language_model1(input_ids=input_ids, segment_ids=segment_ids,
+                                                    padding_mask=attention_mask)
+        return pooled_output[:n_queries], pooled_output[n_queries:]
+
     def log_params(self):
         """
         Logs paramteres to generic logger MlLogger
@@ -429,14 +625,16 @@ class BiAdaptiveModel(nn.Module, BaseBiAdaptiveModel):
         """ Verifies that the model fits to the tokenizer vocabulary.
         They could diverge in case of custom vocabulary added via tokenizer.add_tokens()"""
 
-        model1_vocab_len = self.language_model1.model.resize_token_embeddings(new_num_tokens=None).num_embeddings
+        # read the vocab size straight from the config: resize_token_embeddings(new_num_tokens=None)
+        # goes through the embedding-resizing machinery just to return the embedding module
+        model1_vocab_len = self.language_model1.model.config.vocab_size
 
         msg = f"Vocab size of tokenizer {vocab_size1} doesn't match with model {model1_vocab_len}. " \
               "If you added a custom vocabulary to the tokenizer, " \
               "make sure to supply 'n_added_tokens' to LanguageModel.load() and BertStyleLM.load()"
         assert vocab_size1 == model1_vocab_len, msg
 
-        model2_vocab_len = self.language_model2.model.resize_token_embeddings(new_num_tokens=None).num_embeddings
+        model2_vocab_len = self.language_model2.model.config.vocab_size
 
         msg = f"Vocab size of tokenizer {vocab_size1} doesn't match with model {model2_vocab_len}. " \
               "If you added a custom vocabulary to the tokenizer, " \
@@ -0,0 +1,62 @@
+import logging
+
+from farm.modeling.predictions import QACandidate, QAPred
+
+
+def create_qa_pred():
+    context = "My name is Carla and I live in Berlin"
+    # start character index of each token in the context
+    token_offsets = [0, 3, 8, 11, 17, 21, 23, 28, 31]
+    span_candidate = QACandidate(
+        answer_type="span",
+        score=11.87,
+        offset_answer_start=3,
+        offset_answer_end=3,
+        offset_unit="token",
+        aggregation_level="passage",
+        n_passages_in_doc=1,
+        passage_id="0",
+    )
+    no_answer_candidate = QACandidate(
+        answer_type="no_answer",
+        score=-4.52,
+        offset_answer_start=-1,
+        offset_answer_end=-1,
+        offset_unit="token",
+        aggregation_level="passage",
+        n_passages_in_doc=1,
+        passage_id=None,
+    )
+    return QAPred(
+        id="0-0",
+        prediction=[span_candidate, no_answer_candidate],
+        context=context,
+        question="What is my name?",
+        token_offsets=token_offsets,
+        context_window_size=50,
+        aggregation_level="document",
+        no_answer_gap=7.35,
+    )
+
+
+def test_batch_to_squad_eval_matches_to_squad_eval(caplog=None):
+    if caplog:
+        caplog.set_level(logging.CRITICAL)
+
+    pred = create_qa_pred()
+    assert QAPred.batch_to_squad_eval([pred]) == [pred.to_squad_eval()]
+
+
+def test_batch_to_squad_eval_no_answer_is_empty_string(caplog=None):
+    if caplog:
+        caplog.set_level(logging.CRITICAL)
+
+    pred = create_qa_pred()
+    answers = QAPred.batch_to_squad_eval([pred])[0]["predictions"][0]["answers"]
+    assert answers[0]["answer"] == "Carla"
+    assert answers[1]["answer"] == ""
+
+
+if __name__ == "__main__":
+    test_batch_to_squad_eval_matches_to_squad_eval()
+    test_batch_to_squad_eval_no_answer_is_empty_string()